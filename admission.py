@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+admission control
+"""
+from collections import deque
+import asyncio
+import threading
+import time
+
+# Requests rejected within this many seconds still count as saturation
+SATURATION_WINDOW = 10
+
+class Pool:
+    """
+    Concurrency limit and waiting queue of one request class.
+    """
+    def __init__(self, limit=8, max_queue=8, queue_timeout=0.5):
+        """
+        :param limit: Number of requests processed at the same time.
+        :param max_queue: Number of requests waiting for a slot, more are rejected right away.
+        :param queue_timeout: Seconds a request may wait in total, including the time queued before the worker.
+        """
+        self.limit = max(1, int(limit))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = float(queue_timeout)
+        self.condition = threading.Condition()
+        # Futures of requests waiting on an event loop, woken in order by release
+        self.async_waiters = deque()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+        self.last_rejection = None
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+        self.last_rejection = time.monotonic()
+        return False
+
+class AdmissionController:
+    """
+    Limits the number of requests a worker processes at the same time, per request class.
+
+    Every class has its own slots, so a spike of redirects cannot starve the admin API and a
+    large import cannot starve the redirects. Requests wait for a slot only as long as their
+    queue-time budget allows and are rejected otherwise, so the worker sheds load instead of
+    building up latency.
+    """
+    def __init__(self, enabled=True, retry_after=5, header='X-Request-Start', classes=None):
+        """
+        :param enabled: Set to False to admit every request.
+        :param retry_after: Seconds sent in the Retry-After header of rejected requests.
+        :param header: Header in which a proxy passes the time it received the request, or None.
+        :param classes: Pool settings per request class ('limit', 'max_queue', 'queue_timeout').
+        """
+        self.enabled = enabled
+        self.retry_after = int(retry_after)
+        self.header = header
+        self.pools = {name: Pool(**settings) for name, settings in (classes or {}).items()}
+
+    def queued_for(self, value, now=None):
+        """
+        Time a request spent queued before the worker, from a request start header.
+
+        :param value: The header value, 't=<timestamp>' or '<timestamp>' in seconds, milliseconds or microseconds.
+        :param now: The current time in seconds, defaults to now.
+        :return: Seconds queued, 0 if the header is missing or invalid.
+        """
+        if not value:
+            return 0.0
+        try:
+            start = float(value.strip().removeprefix('t='))
+        except ValueError:
+            return 0.0
+        if start > 1e14:
+            start /= 1e6
+        elif start > 1e11:
+            start /= 1e3
+        return max(0.0, (now or time.time()) - start)
+
+    def _enter(self, pool, deadline):
+        """
+        Take a free slot, or join the queue. Must be called with the pool's condition held.
+
+        :return: True if admitted, None if the request has to wait, False if it was rejected.
+        """
+        if deadline <= time.monotonic():
+            return pool.reject('timeout')
+        if pool.in_flight < pool.limit and pool.waiting == 0:
+            pool.in_flight += 1
+            pool.admitted += 1
+            return True
+        if pool.waiting >= pool.max_queue:
+            return pool.reject('queue_full')
+        pool.waiting += 1
+        return None
+
+    def _take_turn(self, pool, deadline):
+        """
+        Take a free slot for a waiting request. Must be called with the pool's condition held.
+
+        :return: True if admitted, None if it has to wait longer, False if its budget is used up.
+        """
+        if pool.in_flight < pool.limit:
+            pool.waiting -= 1
+            pool.in_flight += 1
+            pool.admitted += 1
+            return True
+        if deadline <= time.monotonic():
+            pool.waiting -= 1
+            return pool.reject('timeout')
+        return None
+
+    def acquire(self, name, queued=0.0):
+        """
+        Wait for a slot of a request class.
+
+        :param name: The request class.
+        :param queued: Seconds the request was already queued before the worker.
+        :return: True if the request may proceed and has to be released, False if it was rejected.
+        """
+        if not self.enabled:
+            return True
+        pool = self.pools[name]
+        deadline = time.monotonic() + pool.queue_timeout - queued
+        with pool.condition:
+            admitted = self._enter(pool, deadline)
+            while admitted is None:
+                pool.condition.wait(max(0.0, deadline - time.monotonic()))
+                admitted = self._take_turn(pool, deadline)
+        return admitted
+
+    async def acquire_async(self, name, queued=0.0):
+        """
+        Like acquire, for the event loop: waiting requests await a future that release resolves
+        instead of blocking the loop.
+        """
+        if not self.enabled:
+            return True
+        pool = self.pools[name]
+        deadline = time.monotonic() + pool.queue_timeout - queued
+        loop = asyncio.get_running_loop()
+        with pool.condition:
+            admitted = self._enter(pool, deadline)
+            if admitted is None:
+                waiter = self._add_waiter(pool, loop)
+        while admitted is None:
+            try:
+                await asyncio.wait_for(waiter, max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # The request was cancelled while queued
+                with pool.condition:
+                    self._remove_waiter(pool, waiter)
+                    pool.waiting -= 1
+                    self._wake_async(pool)
+                raise
+            with pool.condition:
+                self._remove_waiter(pool, waiter)
+                admitted = self._take_turn(pool, deadline)
+                if admitted is None:
+                    waiter = self._add_waiter(pool, loop)
+                elif admitted is False:
+                    # Hand a slot that was meant for this request to the next one
+                    self._wake_async(pool)
+        return admitted
+
+    def _add_waiter(self, pool, loop):
+        waiter = loop.create_future()
+        pool.async_waiters.append(waiter)
+        return waiter
+
+    def _remove_waiter(self, pool, waiter):
+        try:
+            pool.async_waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _wake_async(self, pool):
+        """
+        Wake the longest waiting async request if a slot is free. Must be called with the pool's condition held.
+        """
+        if pool.async_waiters and pool.in_flight < pool.limit:
+            waiter = pool.async_waiters.popleft()
+            waiter.get_loop().call_soon_threadsafe(_resolve, waiter)
+
+    def release(self, name):
+        if not self.enabled:
+            return
+        pool = self.pools[name]
+        with pool.condition:
+            pool.in_flight -= 1
+            pool.condition.notify()
+            self._wake_async(pool)
+
+    def saturated(self):
+        """
+        :return: True if a class uses all of its slots or rejected requests recently.
+        """
+        now = time.monotonic()
+        return self.enabled and any(
+            pool.in_flight >= pool.limit
+            or (pool.last_rejection is not None and now - pool.last_rejection < SATURATION_WINDOW)
+            for pool in self.pools.values()
+        )
+
+    def stats(self):
+        return {
+            name: {
+                'in_flight': pool.in_flight,
+                'limit': pool.limit,
+                'waiting': pool.waiting,
+                'max_queue': pool.max_queue,
+                'admitted': pool.admitted,
+                'rejected': dict(pool.rejected),
+            }
+            for name, pool in self.pools.items()
+        }
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
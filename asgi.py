@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+async url redirect
+
+Serves the redirects, the healthcheck and the read APIs with an async database driver
+(aiosqlite, or asyncpg from requirements-postgresql.txt for PostgreSQL, through SQLAlchemy's asyncio extension). All other routes, including the admin
+write endpoints, are handed to the Flask app in main.py, which shares the same database,
+caches and event writer.
+
+The fallback runs the Flask app on a thread pool sized to the admission slots and queues, so admin requests
+are handled concurrently; asgiref's WsgiToAsgi alone would run all of them on a single thread.
+
+    gunicorn -w 3 -k uvicorn.workers.UvicornWorker asgi:app
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import asyncio
+import gzip
+import json
+import time
+import zlib
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from cache import MISS
+from urldb import ResolvedKey, State, REDIRECT_OPTIONS, install_sqlite_pragmas, resolved_record
+import main
+
+# Async drivers per database backend
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+LISTING_COLUMNS = [ResolvedKey.key, ResolvedKey.redirect] + [getattr(ResolvedKey, name) for name in REDIRECT_OPTIONS]
+
+class AsyncRedirectApp:
+    """
+    ASGI application for the read paths, falling back to the WSGI app for everything else.
+    """
+    def __init__(self, db, fallback):
+        """
+        :param db: The DatabaseManager of the WSGI app, whose caches are shared.
+        :param fallback: ASGI application for all other routes.
+        """
+        self.db = db
+        self.fallback = fallback
+        self.engine = create_async_engine(
+            db.engine.url.set(drivername=ASYNC_DRIVERS[db.dialect]),
+            echo=False,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=db.profile['pool_size'],
+            max_overflow=db.profile['max_overflow'],
+            pool_timeout=db.profile['pool_timeout'],
+            pool_recycle=db.profile['pool_recycle'],
+            pool_pre_ping=db.profile['pool_pre_ping'],
+        )
+        if db.dialect == 'sqlite':
+            install_sqlite_pragmas(self.engine.sync_engine, db.profile)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            path = scope['path']
+            if path == '/api/health':
+                return await self.timed(scope, send, '/api/health', self.health)
+            if path == '/api/get_all_redirects':
+                return await self.timed(scope, send, '/api/get_all_redirects', self.admitted(self.get_all_redirects))
+            if path.count('/') == 1 and len(path) > 1:
+                return await self.timed(scope, send, '/<string:key>', self.admitted(self.redirect))
+        return await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                main.events.close()
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def timed(self, scope, send, route, handler):
+        start = time.perf_counter()
+        status = await handler(scope, send)
+        if main.metrics_config['enabled']:
+            labels = (('route', route), ('method', scope['method']), ('status', str(status)))
+            main.metrics.inc('http_requests_total', labels)
+            main.metrics.observe('http_request_duration_seconds', time.perf_counter() - start, labels)
+            main.metrics.maybe_flush()
+
+    async def resolve(self, key):
+        """
+        Async counterpart of DatabaseManager._resolve, sharing its cache and generation.
+        """
+        if self.db._generation_check_due():
+            async with self.engine.connect() as con:
+                generation = await con.scalar(select(State.value).where(State.name == 'generation'))
+            self.db._apply_generation(generation)
+        if self.db._key_filter_due():
+            # Rebuilding reads all keys, so it runs outside of the event loop
+            asyncio.get_running_loop().run_in_executor(None, self.db._rebuild_key_filter)
+        elif self.db._filter_excludes(key):
+            return None
+        version = self.db.cache.version
+        resolved = self.db.cache.get(key)
+        if resolved is not MISS:
+            return resolved
+        async with self.engine.connect() as con:
+            row = (await con.execute(select(ResolvedKey).where(ResolvedKey.key == key))).first()
+        resolved = resolved_record(row) if row else None
+        self.db._count_filter_result(resolved)
+        self.db.cache.set(key, resolved, version)
+        return resolved
+
+    def admitted(self, handler):
+        """
+        Wraps a handler with what the Flask app does before every request: refresh the config
+        and wait for an admission slot of the request class.
+        """
+        async def run(scope, send):
+            main.config.refresh()
+            name = main.request_class(scope['path'])
+            if name is None:
+                return await handler(scope, send)
+            admission = main.admission
+            header = get_headers(scope).get(admission.header.lower()) if admission.header else None
+            if not await admission.acquire_async(name, admission.queued_for(header)):
+                return await send_response(send, *main.overloaded_response())
+            try:
+                return await handler(scope, send)
+            finally:
+                admission.release(name)
+        return run
+
+    async def redirect(self, scope, send):
+        headers = get_headers(scope)
+        key = scope['path'][1:]
+        ip = main.client_ip(headers.get('x-forwarded-for'), (scope.get('client') or [None])[0])
+        # The limiter and the event writer take locks and may write, so they run off the event loop
+        if not await asyncio.to_thread(main.limiter.allow, ip):
+            return await send_response(send, 500, {'Content-Type': 'application/json'},
+                                       json.dumps({'message': 'Not allowed', 'error': 'too many requests'}))
+
+        resolved = await self.resolve(key)
+        if resolved is None:
+            return await send_response(send, 303, {'Location': '/'}, b'')
+
+        await asyncio.to_thread(main.events.add, key=key, source=ip)
+        # Rendering the page needs the Flask app context
+        with main.app.app_context():
+            status, response_headers, body = main.redirect_response(resolved)
+        return await send_response(send, status, response_headers, body)
+
+    async def health(self, scope, send):
+        payload, status = main.HealthCheck().get()
+        return await send_response(send, status, {'Content-Type': 'application/json'}, json.dumps(payload))
+
+    async def get_all_redirects(self, scope, send):
+        headers = get_headers(scope)
+        args = {name: values[-1] for name, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+        use_gzip = 'gzip' in headers.get('accept-encoding', '')
+        limit = None
+        if 'after' in args or 'limit' in args:
+            try:
+                limit = main.int_arg(args, 'limit', 1000, maximum=10000)
+            except ValueError as e:
+                return await send_response(send, 400, {'Content-Type': 'application/json'},
+                                           json.dumps({'message': 'Invalid request', 'error': str(e)}))
+
+        async with self.engine.connect() as con:
+            version = str(await con.scalar(select(State.value).where(State.name == 'generation')))
+        etag = f'W/"{version}"'
+        if any(tag.strip() in (etag, f'"{version}"', '*') for tag in headers.get('if-none-match', '').split(',')):
+            return await send_response(send, 304, {'ETag': etag}, b'')
+
+        response_headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+        if use_gzip:
+            response_headers['Content-Encoding'] = 'gzip'
+
+        if args.get('format') == 'ndjson':
+            response_headers['Content-Type'] = 'application/x-ndjson'
+            await send_start(send, 200, response_headers)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+            async with self.engine.connect() as con:
+                rows = await con.stream(select(*LISTING_COLUMNS).order_by(ResolvedKey.key))
+                async for partition in rows.partitions(1000):
+                    chunk = ''.join(json.dumps(row._asdict()) + '\n' for row in partition).encode('utf-8')
+                    if compressor:
+                        chunk = compressor.compress(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': compressor.flush() if compressor else b''})
+            return 200
+
+        query = select(*LISTING_COLUMNS)
+        if limit is not None:
+            if args.get('after') is not None:
+                query = query.where(ResolvedKey.key > args['after'])
+            query = query.order_by(ResolvedKey.key).limit(limit)
+        else:
+            # Redirects first, then aliases
+            query = query.order_by(ResolvedKey.is_alias)
+        async with self.engine.connect() as con:
+            redirects = [row._asdict() for row in await con.execute(query)]
+        payload = {'redirects': redirects}
+        if limit is not None and len(redirects) == limit:
+            payload['next'] = redirects[-1]['key']
+
+        body = json.dumps(payload).encode('utf-8')
+        if use_gzip:
+            body = gzip.compress(body)
+        response_headers['Content-Type'] = 'application/json'
+        return await send_response(send, 200, response_headers, body)
+
+def get_headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+
+async def send_start(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()],
+    })
+
+async def send_response(send, status, headers, body):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send_start(send, status, {**headers, 'Content-Length': len(body)})
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """
+    WsgiToAsgi that runs the WSGI app on a thread pool instead of asgiref's single thread.
+    """
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # asgiref wraps run_wsgi_app in a thread-sensitive sync_to_async, rewrap the plain function
+        run = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+        await sync_to_async(run, thread_sensitive=False, executor=self.executor)(self, body)
+
+# Admission control bounds the requests in flight and queued, so more threads would only idle
+FALLBACK_THREADS = max(1, sum(pool.limit + pool.max_queue for pool in main.admission.pools.values()))
+
+app = AsyncRedirectApp(main.db, PooledWsgiToAsgi(main.app, FALLBACK_THREADS))
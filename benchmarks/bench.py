@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks for the redirect hot path and the admin API
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from generate import generate
+
+API_KEY = 'benchmark'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def measure(func, iterations, ops_per_call=1, warmup=10):
+    """
+    Call func repeatedly and collect latency statistics.
+
+    :param func: Callable taking the iteration number.
+    :param iterations: Number of measured calls.
+    :param ops_per_call: Number of operations one call performs, for the throughput.
+    :param warmup: Number of unmeasured calls before the measurement.
+    :return: A dictionary with throughput, latency percentiles in milliseconds and peak RSS.
+    """
+    for i in range(warmup):
+        func(i)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func(i)
+        latencies.append((time.perf_counter() - t) * 1000)
+    total = time.perf_counter() - start
+    return {
+        'iterations': iterations,
+        'ops': iterations * ops_per_call,
+        'seconds': round(total, 4),
+        'throughput': round(iterations * ops_per_call / total, 2),
+        'mean_ms': round(statistics.mean(latencies), 4),
+        'p50_ms': round(percentile(latencies, 50), 4),
+        'p95_ms': round(percentile(latencies, 95), 4),
+        'p99_ms': round(percentile(latencies, 99), 4),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def check(response, *statuses):
+    if response.status_code not in statuses:
+        raise RuntimeError(f"Unexpected status {response.status_code}: {response.data[:200]}")
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='urlredirect-bench-')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    t = time.perf_counter()
+    dataset = generate(os.path.join(data_dir, 'data.db'), redirects=args.redirects,
+                       aliases=args.aliases, events=args.events, seed=args.seed)
+    generate_seconds = time.perf_counter() - t
+
+    with open(os.path.join(data_dir, 'config.yml'), 'w') as file:
+        json.dump({'api_keys': [{'name': 'benchmark', 'key': API_KEY}]}, file)
+
+    # main.py reads data/ relative to the working directory
+    os.chdir(workdir)
+    import main
+
+    rng = random.Random(args.seed)
+    client = main.app.test_client()
+    auth = {'Authorization': API_KEY}
+    keys = dataset['keys']
+    aliases = dataset['aliases'] or keys
+    n = args.requests
+
+    def source(i):
+        # Spread the requests over many sources, so the rate limit does not kick in
+        return {'X-Forwarded-For': f'192.168.{(i // 256) % 256}.{i % 256}'}
+
+    cases = {}
+    cases['redirect_to_url'] = measure(
+        lambda i: check(client.get('/' + rng.choice(keys), headers=source(i)), 200, 301, 302), n)
+    cases['redirect_to_url_alias'] = measure(
+        lambda i: check(client.get('/' + rng.choice(aliases), headers=source(i)), 200, 301, 302), n)
+    cases['redirect_to_url_unknown'] = measure(
+        lambda i: check(client.get(f'/unknown{i}', headers=source(i)), 303), n)
+    # Replaces DatabaseManager._allow_request
+    cases['rate_limiter_allow'] = measure(
+        lambda i: main.limiter.allow(f'172.16.{(i // 256) % 256}.{i % 256}'), n)
+    cases['add_event'] = measure(
+        lambda i: main.db._add_event(key=rng.choice(keys), source='10.1.0.1'), max(1, n // 10))
+    cases['event_writer_add'] = measure(
+        lambda i: main.events.add(key=rng.choice(keys), source='10.1.0.1'), n)
+    cases['get_all_redirects'] = measure(
+        lambda i: check(client.get('/api/get_all_redirects'), 200), args.list_requests, warmup=1)
+    cases['bulk_add'] = measure(
+        lambda i: check(client.post('/api/bulk?results=errors', headers=auth, json=[
+            {'type': 'redirect', 'key': f'bulk{i}-{j}', 'redirect': f'https://example.org/bulk/{i}/{j}'}
+            for j in range(args.bulk_size)
+        ]), 200), args.bulk_requests, ops_per_call=args.bulk_size, warmup=1)
+
+    main.events.close()
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redirects': args.redirects,
+            'aliases': args.aliases,
+            'events': args.events,
+            'requests': n,
+            'seed': args.seed,
+            'generate_seconds': round(generate_seconds, 2),
+        },
+        'cases': cases,
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Compare two result files.
+
+    :param baseline: Results of the reference run.
+    :param current: Results of the run under test.
+    :param threshold: Allowed relative slowdown of p50 latency and throughput.
+    :return: The names of the cases that regressed.
+    """
+    regressions = []
+    print(f"{'case':<26}{'p50 ms':>22}{'p99 ms':>22}{'ops/s':>24}")
+    for name, new in current['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print(f"{name:<26}{'(new)':>22}")
+            continue
+
+        def change(key):
+            return (new[key] - old[key]) / old[key] if old[key] else 0.0
+
+        print(f"{name:<26}"
+              f"{old['p50_ms']:>9.3f} → {new['p50_ms']:<7.3f}{change('p50_ms'):>+6.0%}"
+              f"{old['p99_ms']:>9.3f} → {new['p99_ms']:<7.3f}{change('p99_ms'):>+6.0%}"
+              f"{old['throughput']:>10.0f} → {new['throughput']:<8.0f}{change('throughput'):>+6.0%}")
+        if change('p50_ms') > threshold or change('throughput') < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the redirect hot path and the admin API')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Generate a dataset, run all cases and write the results as JSON')
+    run_parser.add_argument('--output', default='-', help='Result file (default: stdout)')
+    run_parser.add_argument('--workdir', default=None, help='Directory for the generated data (default: a new temporary directory)')
+    run_parser.add_argument('--redirects', type=int, default=10000, help='Number of redirects (default: 10000)')
+    run_parser.add_argument('--aliases', type=int, default=2000, help='Number of aliases (default: 2000)')
+    run_parser.add_argument('--events', type=int, default=100000, help='Number of historical events (default: 100000)')
+    run_parser.add_argument('--requests', type=int, default=2000, help='Iterations of the per-request cases (default: 2000)')
+    run_parser.add_argument('--list-requests', type=int, default=20, help='Iterations of get_all_redirects (default: 20)')
+    run_parser.add_argument('--bulk-requests', type=int, default=10, help='Iterations of bulk_add (default: 10)')
+    run_parser.add_argument('--bulk-size', type=int, default=1000, help='Operations per bulk request (default: 1000)')
+    run_parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('baseline', help='Result file of the reference run')
+    compare_parser.add_argument('current', help='Result file of the run under test')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative slowdown (default: 0.1)')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run(args)
+        output = json.dumps(results, indent=2)
+        if args.output == '-':
+            print(output)
+        else:
+            with open(args.output, 'w') as file:
+                file.write(output + '\n')
+    elif args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
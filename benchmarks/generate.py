@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+synthetic benchmark data
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from urldb import DatabaseManager
+
+
+def generate(path, redirects=10000, aliases=2000, events=100000, days=30, sources=5000, seed=1):
+    """
+    Build a database with synthetic redirects, aliases and historical events.
+
+    :param path: The database file to create. An existing file is replaced.
+    :param redirects: Number of redirects.
+    :param aliases: Number of aliases, pointing to random redirects.
+    :param events: Number of historical click events.
+    :param days: The events are spread over this many past days.
+    :param sources: Number of distinct source addresses in the events.
+    :param seed: Seed for the random generator.
+    :return: A dictionary with the generated 'keys' and 'aliases'.
+    """
+    rng = random.Random(seed)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    db = DatabaseManager(data=path)
+    keys = [f'key{i:07d}' for i in range(redirects)]
+    alias_keys = [f'alias{i:07d}' for i in range(aliases)]
+
+    db._bulk_apply(
+        {'type': 'redirect', 'key': key, 'redirect': f'https://example.org/{key}'}
+        for key in keys
+    )
+    db._bulk_apply(
+        {'type': 'alias', 'alias': alias, 'key': rng.choice(keys)}
+        for alias in alias_keys
+    )
+
+    now = datetime.utcnow()
+    all_keys = keys + alias_keys
+    batch = []
+    for i in range(events):
+        date = now - timedelta(seconds=rng.uniform(0, days * 86400))
+        source = rng.randrange(sources)
+        batch.append((rng.choice(all_keys), f'10.0.{source // 256}.{source % 256}', date))
+        if len(batch) >= 10000:
+            db._add_events(batch)
+            batch = []
+    db._add_events(batch)
+    db.engine.dispose()
+
+    return {'keys': keys, 'aliases': alias_keys}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic redirect database for benchmarks')
+    parser.add_argument('path', help='Database file to create')
+    parser.add_argument('--redirects', type=int, default=10000, help='Number of redirects (default: 10000)')
+    parser.add_argument('--aliases', type=int, default=2000, help='Number of aliases (default: 2000)')
+    parser.add_argument('--events', type=int, default=100000, help='Number of historical events (default: 100000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    args = parser.parse_args()
+    generate(args.path, redirects=args.redirects, aliases=args.aliases, events=args.events, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bloom filter
+"""
+import hashlib
+import math
+
+class BloomFilter:
+    """
+    Set membership with false positives but no false negatives, in a fixed-size bit array.
+    Keys cannot be removed; rebuild the filter instead.
+    """
+    def __init__(self, capacity=10000, error_rate=0.01):
+        """
+        :param capacity: Number of keys the filter is sized for.
+        :param error_rate: False-positive rate at capacity.
+        """
+        self.capacity = max(1, int(capacity))
+        self.error_rate = float(error_rate)
+        self.bits = max(8, int(math.ceil(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / self.capacity * math.log(2))))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: position i is h1 + i * h2
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def false_positive_rate(self):
+        """
+        :return: The expected false-positive rate at the current number of keys.
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'keys': self.count,
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'memory_bytes': len(self._array),
+            'target_error_rate': self.error_rate,
+            'expected_error_rate': self.false_positive_rate(),
+        }
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+in-process caches
+"""
+from collections import OrderedDict
+import threading
+import time
+
+MISS = object()
+
+class LRUCache:
+    """
+    Bounded, thread-safe LRU cache with an optional time-to-live per entry.
+
+    ``None`` is a valid cached value, so lookups return ``MISS`` when a key is
+    not cached (or expired).
+
+    Every ``clear`` increases ``version``. A caller that computes a value while the
+    cache is cleared passes the version it read before computing to ``set``, so the
+    value computed from outdated data is dropped instead of cached.
+    """
+    def __init__(self, size=10000, ttl=None):
+        """
+        :param size: Maximum number of entries. ``0`` disables the cache.
+        :param ttl: Lifetime of an entry in seconds. ``None`` or ``0`` keeps entries until evicted.
+        """
+        self.size = int(size or 0)
+        self.ttl = float(ttl) if ttl else None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+
+    def get(self, key):
+        """
+        Look up a key and mark it as recently used.
+
+        :param key: The cache key.
+        :return: The cached value or ``MISS``.
+        """
+        if self.size <= 0:
+            return MISS
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        """
+        Store a value, evicting the least recently used entry if the cache is full.
+
+        :param key: The cache key.
+        :param value: The value to store (may be ``None``).
+        :param version: The ``version`` read before the value was computed; the value
+                        is not stored if the cache was cleared since.
+        """
+        if self.size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.version += 1
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+database-cli
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from urldb import *
+
+def run_selfcheck(url):
+    """
+    Run the DatabaseManager operations against one database and check their results.
+
+    :param url: SQLAlchemy URL of a scratch database; its redirects are deleted.
+    :return: A list of (check, error) tuples, error is None if the check passed.
+    """
+    db = DatabaseManager(database={'url': url})
+    db._delete_all()
+    now = datetime.utcnow()
+
+    def schema():
+        version = db._get_schema_history()[-1]['version']
+        assert version == SCHEMA_VERSION, f"schema version {version}, expected {SCHEMA_VERSION}"
+
+    def add():
+        db._ensure_redirect(key='sc-1', redirect='one.org')
+        resolved = db._resolve('sc-1')
+        assert resolved and resolved['url'] == 'https://one.org', f"sc-1 resolved to {resolved}"
+
+    def alias():
+        db._add_alias(alias='sc-1a', key='sc-1')
+        resolved = db._resolve('sc-1a')
+        assert resolved and resolved['url'] == 'https://one.org', f"sc-1a resolved to {resolved}"
+
+    def bulk():
+        report = db._bulk_apply([
+            {'type': 'redirect', 'key': 'sc-2', 'redirect': 'two.org', 'redirect_type': 'temporary', 'max_age': 60},
+            {'type': 'redirect', 'key': 'sc-3', 'redirect': 'three.org'},
+            {'type': 'alias', 'alias': 'sc-3a', 'key': 'sc-3'},
+            {'type': 'redirect', 'key': 'sc-3', 'redirect': 'three.net'},
+            {'type': 'delete', 'key': 'sc-2'},
+        ])
+        assert report['totals'] == {'total': 5, 'created': 3, 'updated': 1, 'deleted': 1}, report['totals']
+        assert db._resolve('sc-3a')['url'] == 'https://three.net'
+        assert db._resolve('sc-2') is None
+
+    def events():
+        assert db._add_events([('sc-3', 'a', now), ('sc-3a', 'b', now), ('unknown', 'c', now)]) == 2
+        stats = db._get_stats(key='sc-3', period='hour')
+        assert stats['hits'] == 2 and stats['aliases'] == {'sc-3a': 1}, stats
+        assert db._get_stats()['top'][0]['key'] == 'sc-3'
+
+    def rollups():
+        db._aggregate_events(now=now + timedelta(hours=2), grace=0)
+        for period in ('hour', 'day'):
+            stats = db._get_stats(key='sc-3', period=period)
+            assert stats['hits'] == 2 and stats['aliases'] == {'sc-3a': 1}, (period, stats)
+            assert sum(bucket['hits'] for bucket in stats['series']) == 2, (period, stats['series'])
+            assert sum(bucket['sources'] for bucket in stats['series']) == 2, (period, stats['series'])
+
+    def export():
+        aliases = db._export()['aliases']
+        assert {'alias': 'sc-3a', 'key': 'sc-3'} in aliases, f"sc-3a missing from the exported aliases {aliases}"
+
+    def lease():
+        name = f'selfcheck_{os.getpid()}_{time.time()}'
+        assert db._acquire_lease(name, 60) is True
+        assert db._acquire_lease(name, 60) is False
+
+    def swap():
+        with db.get_session() as session:
+            rid = session.query(Redirect.rid).filter_by(key='sc-3').scalar()
+        db._clear_staged()
+        db._stage([{'type': 'redirect', 'key': 'sc-3', 'redirect': 'staged.org'}, {'type': 'alias', 'alias': 'sc-x', 'key': 'sc-9'}])
+        assert db._validate_staged()['dangling_aliases'] == ['sc-x']
+        assert db._swap_staged()['swapped'] is False and db._resolve('sc-1') is not None
+        db._clear_staged()
+        db._stage([{'type': 'redirect', 'key': 'sc-3', 'redirect': 'staged.org'}, {'type': 'alias', 'alias': 'sc-3s', 'key': 'sc-3'}])
+        assert db._swap_staged()['swapped'] is True
+        assert db._resolve('sc-1') is None and db._resolve('sc-3s')['url'] == 'https://staged.org'
+        with db.get_session() as session:
+            assert session.query(Redirect.rid).filter_by(key='sc-3').scalar() == rid
+        assert db._rollback_dataset() == {'redirects': 2, 'aliases': 2}
+        assert db._resolve('sc-1a')['url'] == 'https://one.org' and db._resolve('sc-3s') is None
+        assert not any(db._verify_resolved_keys().values())
+        try:
+            db._rollback_dataset()
+            raise AssertionError('A second rollback must fail')
+        except ValueError:
+            pass
+
+    def delete():
+        db._delete_redirect('sc-3')
+        assert db._resolve('sc-3') is None and db._resolve('sc-3a') is None
+        assert not any(db._verify_resolved_keys().values())
+
+    def migrations():
+        created = db._migrate()
+        assert created == [], f"a second migration created {created}"
+
+    checks = [
+        ('schema', schema),
+        ('add and resolve', add),
+        ('alias', alias),
+        ('bulk upsert', bulk),
+        ('events and stats', events),
+        ('rollups', rollups),
+        ('lease', lease),
+        ('export', export),
+        ('staged swap and rollback', swap),
+        ('delete', delete),
+        ('migrations are idempotent', migrations),
+    ]
+    results = []
+    for name, check in checks:
+        try:
+            check()
+            results.append((name, None))
+        except Exception as e:
+            results.append((name, repr(e)))
+    db._delete_all()
+    db.engine.dispose()
+    return results
+
+
+def print_event_storage(title, storage):
+    print(title)
+    for name, stats in storage.items():
+        size = 'size unknown'
+        if stats['bytes'] is not None:
+            size = f"{stats['bytes'] / 1e6:.1f} MB"
+            if stats['rows']:
+                size += f" ({stats['bytes'] / stats['rows']:.0f} bytes per row)"
+        scan = f", full scan {stats['scan_seconds']:.3f} s" if stats['scan_seconds'] is not None else ''
+        print(f"  {name}: {stats['rows']} rows, {size}{scan}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands for the redirect database')
+    parser.add_argument('--db', default='data/data.db', help='Path to the database file (default: data/data.db)')
+    parser.add_argument('--url', help='SQLAlchemy URL of the database, instead of --db')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild-resolved', help='Rebuild the resolved_keys table from redirects and aliases')
+    subparsers.add_parser('verify-resolved', help='Check the resolved_keys table against redirects and aliases')
+    rollup_parser = subparsers.add_parser('rollup', help='Aggregate closed hours and days into the rollup tables')
+    rollup_parser.add_argument('--max-buckets', type=int, default=168, help='Maximum buckets per period in one run (default: 168)')
+    archive_parser = subparsers.add_parser('archive', help='Archive raw events older than the retention period and vacuum')
+    archive_parser.add_argument('--days', type=int, required=True, help='Number of days raw events are kept')
+    archive_parser.add_argument('--directory', default='data/archive', help='Directory of the archive files (default: data/archive)')
+    archive_parser.add_argument('--batch-size', type=int, default=5000, help='Events per batch (default: 5000)')
+    compact_parser = subparsers.add_parser('compact-events', help='Move the events left in events_legacy to the compact table and report the storage before and after')
+    compact_parser.add_argument('--batch-size', type=int, default=5000, help='Events per batch (default: 5000)')
+    subparsers.add_parser('schema', help='Show the applied schema migrations')
+    subparsers.add_parser('enable-incremental-vacuum', help='Switch an existing database to incremental vacuum (stop the service first)')
+    selfcheck_parser = subparsers.add_parser('selfcheck', help='Run the database checks against SQLite in memory, a SQLite file and --backend URLs')
+    selfcheck_parser.add_argument('--backend', action='append', default=[], help='URL of a scratch database to check as well (repeatable), its data is deleted')
+
+    args = parser.parse_args()
+
+    if args.command == 'selfcheck':
+        with tempfile.TemporaryDirectory() as directory:
+            backends = ['sqlite://', f"sqlite:///{os.path.join(directory, 'selfcheck.db')}"] + args.backend
+            matrix = {backend: run_selfcheck(backend) for backend in backends}
+        failed = False
+        for backend, results in matrix.items():
+            print(f"\n{backend}")
+            for name, error in results:
+                print(f"  {'ok  ' if error is None else 'FAIL'} {name}" + (f": {error}" if error else ''))
+                failed = failed or error is not None
+        sys.exit(1 if failed else 0)
+
+    db = DatabaseManager(data=args.db, database={'url': args.url})
+
+    if args.command == 'rebuild-resolved':
+        count = db._rebuild_resolved_keys()
+        print(f"Rebuilt {count} resolved keys.")
+    elif args.command == 'verify-resolved':
+        report = db._verify_resolved_keys()
+        for problem, keys in report.items():
+            print(f"{problem}: {len(keys)}")
+            for key in keys:
+                print(f"  {key}")
+        if any(report.values()):
+            sys.exit(1)
+    elif args.command == 'rollup':
+        while True:
+            aggregated = db._aggregate_events(max_buckets=args.max_buckets)
+            print(f"Aggregated {aggregated['hour']} hours and {aggregated['day']} days.")
+            if max(aggregated.values()) < args.max_buckets:
+                break
+    elif args.command == 'archive':
+        while True:
+            result = db._archive_events(days=args.days, directory=args.directory, batch_size=args.batch_size)
+            print(f"Archived {result['archived']} events, freed {result['freed_pages']} pages.")
+            if result['archived'] == 0:
+                break
+    elif args.command == 'compact-events':
+        print_event_storage('Before:', db._event_storage())
+        result = db._compact_events(batch_size=args.batch_size)
+        freed = db._incremental_vacuum()
+        print(f"Freed {freed} pages.")
+        print_event_storage('After:', db._event_storage())
+    elif args.command == 'schema':
+        for migration in db._get_schema_history():
+            print(f"{migration['version']:>4}  {migration['applied']:%Y-%m-%d %H:%M}  {migration['description']}")
+    elif args.command == 'enable-incremental-vacuum':
+        mode = db._enable_incremental_vacuum()
+        print(f"auto_vacuum={mode}")
+
+if __name__ == "__main__":
+    main()
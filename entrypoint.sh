@@ -1,2 +1,8 @@
 #!/bin/sh
-gunicorn -w 3 -b 0.0.0.0:5000 main:app
\ No newline at end of file
+# SERVER_MODE=asgi serves the redirects with async workers (see asgi.py)
+# Threaded workers need at least as many threads as the admission slots and queues (admission.py)
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    gunicorn -w 3 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:5000 asgi:app
+else
+    gunicorn -w 3 -k gthread --threads "${GUNICORN_THREADS:-20}" -b 0.0.0.0:5000 main:app
+fi
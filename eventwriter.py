@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+buffered event writer
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+FULL_POLICIES = ('drop', 'block')
+
+class EventWriter:
+    """
+    Buffers click events in a bounded in-memory queue and writes them in batches
+    from a background thread, so the request path never waits for the database.
+    """
+    def __init__(self, db, batch_size=500, flush_interval_ms=1000, queue_size=10000, full_policy='drop', block_timeout_ms=1000):
+        """
+        :param db: The DatabaseManager used to store the events.
+        :param batch_size: Maximum number of events written in one transaction.
+        :param flush_interval_ms: Maximum time an event waits in the queue before it is written.
+        :param queue_size: Maximum number of buffered events.
+        :param full_policy: 'drop' discards new events while the queue is full, 'block' waits up to block_timeout_ms.
+        :param block_timeout_ms: Maximum wait for a free slot with the 'block' policy.
+        """
+        if full_policy not in FULL_POLICIES:
+            raise ValueError(f"Unknown full_policy '{full_policy}', expected one of {FULL_POLICIES}.")
+
+        self.db = db
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0, int(flush_interval_ms)) / 1000
+        self.queue_size = int(queue_size)
+        self.full_policy = full_policy
+        self.block_timeout = None if block_timeout_ms is None else int(block_timeout_ms) / 1000
+
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stop = None
+        self._thread = None
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        """
+        Start the writer thread, once per process (gunicorn forks workers after import).
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='event-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def add(self, key=None, source=None):
+        """
+        Queue a click event. Never touches the database.
+
+        :param key: The key of the redirect or alias.
+        :param source: The source of the event.
+        :return: True if the event was queued, False if it was dropped.
+        """
+        if key is None or source is None:
+            raise ValueError("Both 'key' and 'source' must be provided.")
+
+        self._ensure_started()
+        event = (key, source, datetime.utcnow())
+        try:
+            if self.full_policy == 'block':
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _take_batch(self):
+        """
+        Collect up to batch_size events, waiting at most flush_interval after the first one.
+
+        :return: A list of queued events.
+        """
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval or 0.1))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0 or self._stop.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        batch = [event for event in batch if event is not None]
+        if not batch:
+            return
+        written = self.db._add_events(batch)
+        if written is None:
+            self.failed += len(batch)
+        else:
+            self.flushed += written
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+        self._drain()
+
+    def _drain(self):
+        """
+        Write everything that is still queued.
+        """
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                return
+            self._write(batch)
+
+    def depth(self):
+        """
+        :return: The number of events waiting to be written.
+        """
+        if self._pid != os.getpid():
+            return 0
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        :return: A dictionary with the queue depth and the flushed, dropped and failed counters.
+        """
+        return {
+            'queued': self.depth(),
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def close(self, timeout=10):
+        """
+        Stop the writer thread after flushing all queued events.
+
+        :param timeout: Maximum time in seconds to wait for the final flush.
+        """
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        try:
+            # Wake up the writer thread if it is waiting for events
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
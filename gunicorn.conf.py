@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings, loaded automatically from the working directory
+"""
+from helper import ConfigLoader
+from metrics import clear_snapshots
+
+def on_starting(server):
+    # Snapshots of the workers of a previous run would add up with the new ones
+    metrics = ConfigLoader('data/config.yml').get_metrics()
+    if metrics['directory']:
+        clear_snapshots(metrics['directory'])
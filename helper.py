@@ -5,15 +5,32 @@ helper
 """
 import yaml
 import os
+import hashlib
+import signal
+import threading
+import time
+
+def hash_key(key):
+    return hashlib.sha256(key.encode('utf-8')).digest()
 
 class ConfigLoader:
-    def __init__(self, config_file_path, versions='versions.yml'):
+    def __init__(self, config_file_path, versions='versions.yml', check_interval=1):
         self.file_path = config_file_path
         self.versions_file_path = versions
+        self.check_interval = check_interval
 
-        self.config = self.load_config()
+        self._lock = threading.Lock()
+        self._reload_listeners = []
+        self._reload_requested = False
+        self._next_check = 0
+        self._mtime = self._get_mtime()
+        self._snapshot = self._build_snapshot(self.load_config() or {})
         self.versions = self.load_versions()
 
+    @property
+    def config(self):
+        return self._snapshot['config']
+
     def load_config(self):
         """Lädt die Konfiguration aus der YAML-Datei."""
         try:
@@ -22,6 +39,69 @@ class ConfigLoader:
         except:
             return {}
 
+    def _get_mtime(self):
+        try:
+            return os.stat(self.file_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _build_snapshot(self, config):
+        """Berechnet die pro Anfrage benötigten Werte einmal pro Konfigurationsstand vor."""
+        api_keys = config.get('api_keys') or []
+        matomo = config.get('matomo') or {}
+        return {
+            'config': config,
+            'key_hashes': frozenset(hash_key(str(entry['key'])) for entry in api_keys),
+            'matomo': matomo,
+            'matomo_is_enabled': matomo != {},
+            'landing_page': config.get('landing_page', None),
+            'redirect_type': (config.get('redirects') or {}).get('default_type', 'js'),
+            'max_age': (config.get('redirects') or {}).get('max_age'),
+        }
+
+    def refresh(self):
+        """
+        Lädt die Konfiguration neu, wenn sich die Datei geändert hat oder ein SIGHUP empfangen wurde.
+        Die Datei wird höchstens alle check_interval Sekunden geprüft; laufende Anfragen behalten
+        ihren Stand, weil der neue Stand in einem Schritt ausgetauscht wird.
+        """
+        now = time.monotonic()
+        if now < self._next_check and not self._reload_requested:
+            return False
+        with self._lock:
+            self._next_check = now + self.check_interval
+            mtime = self._get_mtime()
+            if mtime == self._mtime and not self._reload_requested:
+                return False
+            self._reload_requested = False
+            self._mtime = mtime
+            try:
+                with open(self.file_path, 'r') as file:
+                    snapshot = self._build_snapshot(yaml.safe_load(file) or {})
+            except Exception as e:
+                # Keep serving the last good configuration
+                print(f"Fehler beim Neuladen der Konfiguration: {e}")
+                return False
+            self._snapshot = snapshot
+        print(f"Konfiguration '{self.file_path}' neu geladen.")
+        for listener in self._reload_listeners:
+            listener()
+        return True
+
+    def add_reload_listener(self, listener):
+        """Registriert eine Funktion, die nach jedem Neuladen aufgerufen wird."""
+        self._reload_listeners.append(listener)
+
+    def install_sighup_handler(self):
+        """Fordert bei SIGHUP ein Neuladen bei der nächsten Anfrage an."""
+        def request_reload(signum, frame):
+            self._reload_requested = True
+        try:
+            signal.signal(signal.SIGHUP, request_reload)
+        except (AttributeError, ValueError):
+            # No SIGHUP on this platform or not in the main thread
+            pass
+
     def load_versions(self):
         """Lädt die Versionen aus der versions.yml-Datei, falls sie existiert."""
         if os.path.exists(self.versions_file_path):
@@ -34,18 +114,133 @@ class ConfigLoader:
         else:
             return {}
     
-    def get_keys(self):
-        api_keys = self.config.get('api_keys', [])
-        return {entry['name']: entry['key'] for entry in api_keys}
+    def is_valid_key(self, key):
+        """
+        Prüft einen API-Key in konstanter Zeit: verglichen werden nur die SHA-256-Hashes,
+        die Laufzeit hängt also nicht davon ab, wie viel des Keys übereinstimmt.
+        """
+        if not key:
+            return False
+        return hash_key(key) in self._snapshot['key_hashes']
     
     def get_landingpage(self):
-        return self.config.get('landing_page', None)
+        return self._snapshot['landing_page']
 
     def get_matomo(self):
-        return self.config.get('matomo', {})
+        return self._snapshot['matomo']
     
+    def get_cache(self):
+        """
+        Einstellungen für den Cache der Key-Auflösung (Größe, TTL in Sekunden), den Key-Filter und die gerenderten Seiten.
+        Änderungen anderer Worker werden spätestens nach generation_check_interval Sekunden bemerkt.
+        """
+        return {
+            'size': 10000,
+            'ttl': 300,
+            'generation_check_interval': 0.1,
+            'pages': 1000,
+            'filter': True,
+            'filter_error_rate': 0.01,
+            'filter_rebuild_interval': 5,
+            **(self.config.get('cache') or {}),
+        }
+
+    def get_redirect_type(self):
+        """Standard-Typ für Redirects ohne eigenen Typ ('js', 'permanent', 'found' oder 'temporary')."""
+        return self._snapshot['redirect_type']
+
+    def get_redirect_max_age(self):
+        """Standard-Cache-Dauer in Sekunden für Redirects ohne eigene; None sendet keine Cache-Header."""
+        return self._snapshot['max_age']
+
+    def get_database(self):
+        """Engine-Profil der Datenbank (URL, Pool und SQLite-Pragmas), nicht gesetzte Werte nutzen die Standardwerte."""
+        return self.config.get('database') or {}
+
+    def get_events(self):
+        """Einstellungen für das gepufferte Schreiben der Klick-Events."""
+        return {
+            'batch_size': 500,
+            'flush_interval_ms': 1000,
+            'queue_size': 10000,
+            'full_policy': 'drop',
+            **(self.config.get('events') or {}),
+        }
+
+    def get_rate_limit(self):
+        """Einstellungen für das Rate-Limit pro Quelle (Anfragen pro Fenster in Sekunden)."""
+        return {
+            'enabled': True,
+            'limit': 30,
+            'window': 120,
+            'max_sources': 100000,
+            'backend': 'memory',
+            'path': 'data/ratelimit.db',
+            **(self.config.get('rate_limit') or {}),
+        }
+
+    def get_admission(self):
+        """Gleichzeitige Anfragen pro Worker und Klasse ('redirect', 'admin') und ihr Warte-Budget in Sekunden."""
+        admission = self.config.get('admission') or {}
+        classes = {
+            'redirect': {'limit': 8, 'max_queue': 8, 'queue_timeout': 0.5},
+            'admin': {'limit': 2, 'max_queue': 2, 'queue_timeout': 10},
+        }
+        return {
+            'enabled': True,
+            'retry_after': 5,
+            'header': 'X-Request-Start',
+            **admission,
+            'classes': {name: {**settings, **((admission.get('classes') or {}).get(name) or {})}
+                        for name, settings in classes.items()},
+        }
+
+    def get_metrics(self):
+        """Einstellungen für /api/metrics; das Verzeichnis teilen sich alle Worker."""
+        return {
+            'enabled': True,
+            'directory': '/tmp/urlredirect-metrics',
+            'flush_interval': 5,
+            **(self.config.get('metrics') or {}),
+        }
+
+    def get_retention(self):
+        """Aufbewahrung der rohen Klick-Events in Tagen (None behält alle), ältere werden monatsweise archiviert."""
+        return {
+            'days': None,
+            'interval': 3600,
+            'directory': 'data/archive',
+            'batch_size': 5000,
+            'max_batches': 100,
+            'vacuum_pages': 1000,
+            **(self.config.get('retention') or {}),
+        }
+
+    def get_stats(self):
+        """Einstellungen für /api/stats (Cache-Größe, TTL in Sekunden, maximale Länge der Top-Liste)."""
+        return {
+            'cache_size': 256,
+            'cache_ttl': 60,
+            'max_top': 1000,
+            **(self.config.get('stats') or {}),
+        }
+
+    def get_rollup(self):
+        """
+        Einstellungen für die stündlichen/täglichen Klick-Aggregate (Intervall und Wartezeit in Sekunden).
+        Die Aggregate warten, bis der compact-events-Job die alten Klick-Events verschoben hat.
+        """
+        return {
+            'interval': 300,
+            'grace': 300,
+            'max_buckets': 168,
+            'compact_interval': 60,
+            'compact_batches': 20,
+            **(self.config.get('rollup') or {}),
+        }
+
     def matomo_is_enabled(self):
-        return self.get_matomo()!={}
+        return self._snapshot['matomo_is_enabled']
     
     def _get_client_version(self):
         """Holt die Version für den Eintrag './redirectmanager' aus self.versions."""
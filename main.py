@@ -5,22 +5,155 @@ url redirect
 """
 from urldb import *
 from helper import *
-from flask import Flask, request, redirect, render_template_string, url_for, render_template
+from eventwriter import EventWriter
+from ratelimit import RateLimiter
+from admission import AdmissionController
+from scheduler import Scheduler
+from cache import LRUCache, MISS
+from metrics import Metrics
+import time
+from flask import Flask, request, redirect, render_template_string, url_for, render_template, Response, stream_with_context, g
 from flask_restful import Api, Resource, reqparse
 from functools import wraps
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date
+import json
+import gzip
+import zlib
 
 config = ConfigLoader('data/config.yml')
 app = Flask(__name__)
 api = Api(app)
 
-db = DatabaseManager(data='data/data.db')
+db = DatabaseManager(data='data/data.db', cache=config.get_cache(), database=config.get_database())
+events = EventWriter(db, **config.get_events())
+limiter = RateLimiter(**config.get_rate_limit())
+admission = AdmissionController(**config.get_admission())
+
+# Rendered redirect pages per target URL, dropped whenever the redirects change
+pages = LRUCache(size=config.get_cache()['pages'])
+db.add_invalidation_listener(pages.clear)
+# The pages embed the Matomo settings
+config.add_reload_listener(pages.clear)
+config.install_sighup_handler()
+
+@app.before_request
+def refresh_config():
+    config.refresh()
+
+## METRICS
+metrics_config = config.get_metrics()
+metrics = Metrics(directory=metrics_config['directory'], flush_interval=metrics_config['flush_interval'])
+metrics.describe('http_requests_total', 'counter', 'HTTP requests by route, method and status.')
+metrics.describe('http_request_duration_seconds', 'histogram', 'HTTP request latency by route, method and status.')
+metrics.describe('db_query_duration_seconds', 'histogram', 'Duration of DatabaseManager methods.')
+metrics.describe('rate_limit_rejections_total', 'counter', 'Requests rejected by the rate limiter.')
+metrics.describe('cache_hits_total', 'counter', 'Cache hits by cache.')
+metrics.describe('cache_misses_total', 'counter', 'Cache misses by cache.')
+metrics.describe('event_queue_depth', 'gauge', 'Click events waiting to be written.')
+metrics.describe('events_written_total', 'counter', 'Click events by outcome of the buffered writer.')
+metrics.describe('key_filter_rejections_total', 'counter', 'Unknown keys answered by the key filter without a lookup.')
+metrics.describe('key_filter_false_positives_total', 'counter', 'Unknown keys that passed the key filter.')
+metrics.describe('admission_rejections_total', 'counter', 'Requests shed by admission control by class and reason.')
+metrics.describe('admission_in_flight', 'gauge', 'Requests being processed by class.')
+metrics.describe('admission_waiting', 'gauge', 'Requests waiting for a slot by class.')
+metrics.instrument(db, [
+    '_lookup_redirect', '_get_generation', '_add_event', '_add_events', '_ensure_redirect', '_add_alias',
+    '_remove_alias', '_delete_redirect', '_rename_key', '_get_all_redirects', '_get_redirects_page',
+    '_bulk_apply', '_export', '_delete_all', '_aggregate_events', '_get_stats',
+    '_rebuild_key_filter', '_archive_events', '_stage', '_validate_staged', '_swap_staged', '_rollback_dataset',
+])
+
+def collect_component_metrics():
+    yield 'counter', 'rate_limit_rejections_total', (), limiter.rejected
+    for name, cache in (('resolve', db.cache), ('pages', pages), ('stats', stats_cache)):
+        yield 'counter', 'cache_hits_total', (('cache', name),), cache.hits
+        yield 'counter', 'cache_misses_total', (('cache', name),), cache.misses
+    yield 'counter', 'key_filter_rejections_total', (), db.filter_negatives
+    yield 'counter', 'key_filter_false_positives_total', (), db.filter_false_positives
+    stats = events.stats()
+    yield 'gauge', 'event_queue_depth', (), stats['queued']
+    for outcome in ('flushed', 'dropped', 'failed'):
+        yield 'counter', 'events_written_total', (('outcome', outcome),), stats[outcome]
+    for name, pool in admission.stats().items():
+        for reason, count in pool['rejected'].items():
+            yield 'counter', 'admission_rejections_total', (('class', name), ('reason', reason)), count
+        yield 'gauge', 'admission_in_flight', (('class', name),), pool['in_flight']
+        yield 'gauge', 'admission_waiting', (('class', name),), pool['waiting']
+metrics.add_collector(collect_component_metrics)
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if metrics_config['enabled'] and 'start_time' in g:
+        labels = (
+            ('route', request.url_rule.rule if request.url_rule else 'unmatched'),
+            ('method', request.method),
+            ('status', str(response.status_code)),
+        )
+        metrics.inc('http_requests_total', labels)
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.start_time, labels)
+        metrics.maybe_flush()
+    return response
+
+## ADMISSION CONTROL
+# Answered even when the worker is saturated
+ADMISSION_EXEMPT = ('/api/health', '/api/metrics')
+
+def request_class(path):
+    """Request class for admission control; None for routes that are always admitted."""
+    if path in ADMISSION_EXEMPT:
+        return None
+    return 'admin' if path.startswith('/api/') else 'redirect'
+
+def overloaded_response():
+    """Response for rejected requests as (status, headers, body)."""
+    body = json.dumps({'message': 'Service overloaded', 'error': 'too many concurrent requests'})
+    return 503, {'Content-Type': 'application/json', 'Retry-After': str(admission.retry_after)}, body
+
+@app.before_request
+def admit_request():
+    name = request_class(request.path)
+    if name is None:
+        return None
+    queued = admission.queued_for(request.headers.get(admission.header) if admission.header else None)
+    if not admission.acquire(name, queued):
+        status, headers, body = overloaded_response()
+        return Response(body, status=status, headers=headers)
+    g.admission_class = name
+
+@app.teardown_request
+def release_request(error=None):
+    name = g.pop('admission_class', None)
+    if name is not None:
+        admission.release(name)
+
+class MetricsEndpoint(Resource):
+    def get(self):
+        return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+api.add_resource(MetricsEndpoint, '/api/metrics')
+
+scheduler = Scheduler(lease=db._acquire_lease)
+rollup = config.get_rollup()
+scheduler.add('rollup', db._aggregate_events, rollup['interval'], exclusive=True,
+              grace=rollup['grace'], max_buckets=rollup['max_buckets'])
+# Moves the events that the schema migration left in events_legacy, a few batches per run
+scheduler.add('compact-events', db._compact_events, rollup['compact_interval'] if db._has_legacy_events() else 0,
+              exclusive=True, max_batches=rollup['compact_batches'])
+retention = config.get_retention()
+scheduler.add('retention', db._archive_events, retention['interval'] if retention['days'] else 0, exclusive=True,
+              days=retention['days'], directory=retention['directory'], batch_size=retention['batch_size'],
+              max_batches=retention['max_batches'], vacuum_pages=retention['vacuum_pages'])
+scheduler.start()
 
 def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         auth_key = request.headers.get('Authorization')
-        valid_keys = config.get_keys()
-        if auth_key not in valid_keys.values():
+        if not config.is_valid_key(auth_key):
             return {'message': 'Unauthorized'}, 401
 
         return f(*args, **kwargs)
@@ -30,6 +163,8 @@ def require_auth(f):
 add_redirect_parser = reqparse.RequestParser()
 add_redirect_parser.add_argument('key', type=str, help='Key for the redirect', required=True)
 add_redirect_parser.add_argument('redirect', type=str, help='Redirect URL', required=True)
+add_redirect_parser.add_argument('redirect_type', type=str, help='How the redirect is served', choices=list(REDIRECT_TYPES), required=False)
+add_redirect_parser.add_argument('max_age', type=int, help='Seconds browsers and proxies may cache the redirect', required=False)
 class AddRedirect(Resource):
     @require_auth
     def post(self):       
@@ -37,6 +172,8 @@ class AddRedirect(Resource):
         data = {
                 'key': args.get('key'),
                 'redirect': args.get('redirect'),
+                'redirect_type': args.get('redirect_type'),
+                'max_age': args.get('max_age'),
                 }
 
         try:
@@ -47,16 +184,91 @@ class AddRedirect(Resource):
 api.add_resource(AddRedirect, '/api/add_redirect')
 
 ## GETTING ALL REDIRECTS
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def gzip_stream(chunks):
+    """Compresses a stream of text chunks incrementally with gzip."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def int_arg(args, name, default, minimum=1, maximum=None):
+    """Reads an integer query parameter, clamped to [minimum, maximum]; raises ValueError if it is not a number."""
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        raise ValueError(f"The '{name}' parameter must be an integer.")
+    value = max(minimum, value)
+    return min(value, maximum) if maximum is not None else value
+
 class GetAllRedirects(Resource):
     def get(self):
+        limit = None
+        if 'after' in request.args or 'limit' in request.args:
+            try:
+                limit = int_arg(request.args, 'limit', 1000, maximum=10000)
+            except ValueError as e:
+                return {'message': 'Invalid request', 'error': str(e)}, 400
         try:
-            redirects = db._get_all_redirects()  # Ruft die Methode zum Abrufen aller Redirects auf
-            return {'redirects': redirects}, 200
+            # The cache generation changes with every write, so it doubles as dataset version
+            version = str(db._get_generation())
+            etag = f'W/"{version}"'
+            if request.if_none_match.contains_weak(version):
+                return Response(status=304, headers={'ETag': etag})
+
+            headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+            if accepts_gzip():
+                headers['Content-Encoding'] = 'gzip'
+
+            if request.args.get('format') == 'ndjson':
+                # Streams the rows from a server-side cursor instead of building the list in memory
+                chunks = (json.dumps(row) + '\n' for row in db._iter_redirects())
+                if accepts_gzip():
+                    chunks = gzip_stream(chunks)
+                return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
+
+            if limit is not None:
+                redirects = db._get_redirects_page(after=request.args.get('after'), limit=limit)
+                payload = {'redirects': redirects}
+                if len(redirects) == limit:
+                    payload['next'] = redirects[-1]['key']
+            else:
+                redirects = db._get_all_redirects()  # Ruft die Methode zum Abrufen aller Redirects auf
+                payload = {'redirects': redirects}
+
+            body = json.dumps(payload).encode('utf-8')
+            if accepts_gzip():
+                body = gzip.compress(body)
+            return Response(body, mimetype='application/json', headers=headers)
         except Exception as e:
             return {'message': 'Failed to retrieve redirects', 'error': str(e)}, 500
 
 api.add_resource(GetAllRedirects, '/api/get_all_redirects')
 
+## EXPORTING REDIRECTS AND ALIASES
+class ExportRedirects(Resource):
+    @require_auth
+    def get(self):
+        try:
+            version = str(db._get_generation())
+            etag = f'W/"{version}"'
+            if request.if_none_match.contains_weak(version):
+                return Response(status=304, headers={'ETag': etag})
+            body = json.dumps(db._export()).encode('utf-8')
+            headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+            if accepts_gzip():
+                headers['Content-Encoding'] = 'gzip'
+                body = gzip.compress(body)
+            return Response(body, mimetype='application/json', headers=headers)
+        except Exception as e:
+            return {'message': 'Failed to export redirects', 'error': str(e)}, 500
+
+api.add_resource(ExportRedirects, '/api/export')
+
 ## ADDING ALIAS
 add_alias_parser = reqparse.RequestParser()
 add_alias_parser.add_argument('alias', type=str, help='The alias key', required=True)
@@ -77,6 +289,100 @@ class AddAlias(Resource):
             return {'message': 'Failed to add alias', 'error': str(e)}, 500    
 api.add_resource(AddAlias, '/api/add_alias')
 
+## BULK UPSERT
+def parse_operation(line):
+    """Parses one NDJSON line; a line that is not valid JSON becomes an invalid operation with the parse error."""
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return {'type': None, 'error': f"Invalid JSON: {e}"}
+
+def read_bulk_operations():
+    """Reads the operations from a JSON body or streams them line by line from an NDJSON body."""
+    if request.mimetype == 'application/x-ndjson':
+        return (parse_operation(line) for line in request.stream if line.strip())
+    try:
+        payload = request.get_json(force=True)
+    except BadRequest:
+        raise ValueError("The body is not valid JSON.")
+    if isinstance(payload, dict):
+        payload = payload.get('operations', [])
+    if not isinstance(payload, list):
+        raise ValueError("Expected a list of operations.")
+    return payload
+
+class BulkUpsert(Resource):
+    @require_auth
+    def post(self):
+        try:
+            chunk_size = int_arg(request.args, 'chunk_size', 1000)
+            operations = read_bulk_operations()
+        except ValueError as e:
+            return {'message': 'Invalid request', 'error': str(e)}, 400
+        try:
+            report = db._bulk_apply(operations, chunk_size=chunk_size)
+            if request.args.get('results') == 'errors':
+                report['results'] = [result for result in report['results'] if result['status'] == 'error']
+            return report, 200
+        except Exception as e:
+            return {'message': 'Failed to apply bulk operations', 'error': str(e)}, 500
+api.add_resource(BulkUpsert, '/api/bulk')
+
+## STAGED DATASET
+class Staging(Resource):
+    @require_auth
+    def get(self):
+        try:
+            return db._validate_staged(), 200
+        except Exception as e:
+            return {'message': 'Failed to validate the staged dataset', 'error': str(e)}, 500
+
+    @require_auth
+    def delete(self):
+        try:
+            db._clear_staged()
+            return {'message': 'Staged dataset discarded'}, 200
+        except Exception as e:
+            return {'message': 'Failed to discard the staged dataset', 'error': str(e)}, 500
+api.add_resource(Staging, '/api/staging')
+
+class StagingLoad(Resource):
+    @require_auth
+    def post(self):
+        try:
+            chunk_size = int_arg(request.args, 'chunk_size', 5000)
+            operations = read_bulk_operations()
+        except ValueError as e:
+            return {'message': 'Invalid request', 'error': str(e)}, 400
+        try:
+            return db._stage(operations, chunk_size=chunk_size), 200
+        except Exception as e:
+            return {'message': 'Failed to stage the operations', 'error': str(e)}, 500
+api.add_resource(StagingLoad, '/api/staging/load')
+
+class StagingSwap(Resource):
+    @require_auth
+    def post(self):
+        try:
+            report = db._swap_staged()
+        except Exception as e:
+            return {'message': 'Failed to swap in the staged dataset', 'error': str(e)}, 500
+        if not report['swapped']:
+            return {'message': 'The staged dataset is not valid', **report}, 409
+        return {'message': 'Staged dataset swapped in', **report}, 200
+api.add_resource(StagingSwap, '/api/staging/swap')
+
+class StagingRollback(Resource):
+    @require_auth
+    def post(self):
+        try:
+            return {'message': 'Previous dataset restored', **db._rollback_dataset()}, 200
+        except ValueError as e:
+            return {'message': 'Failed to roll back', 'error': str(e)}, 409
+        except Exception as e:
+            return {'message': 'Failed to roll back', 'error': str(e)}, 500
+api.add_resource(StagingRollback, '/api/staging/rollback')
+
 ## DELETING ALL REDIRECTS
 class DeleteAllRedirects(Resource):
     @require_auth
@@ -90,30 +396,119 @@ class DeleteAllRedirects(Resource):
 api.add_resource(DeleteAllRedirects, '/api/delete_all_redirects')
 
 ## URL REDIRECT ENDPOINT
+def render_redirect_page(redirect_url):
+    """Renders the redirect page only once per target URL."""
+    version = pages.version
+    page = pages.get(redirect_url)
+    if page is MISS:
+        page = render_template('redirect.html',
+                               redirect=redirect_url,
+                               matomo=config.get_matomo(),
+                               matomo_is_enabled = config.matomo_is_enabled(),
+                               )
+        pages.set(redirect_url, page, version)
+    return page
+
+def cache_headers(max_age):
+    """Cache headers of a redirect; none are set without max_age."""
+    if max_age is None:
+        return {}
+    if max_age <= 0:
+        return {'Cache-Control': 'no-store'}
+    return {
+        'Cache-Control': f'public, max-age={max_age}',
+        'Expires': http_date(time.time() + max_age),
+        'Vary': 'Accept-Encoding',
+    }
+
+def redirect_response(resolved):
+    """Builds the response for a resolved key as (status, headers, body)."""
+    code = REDIRECT_TYPES.get(resolved['redirect_type'] or config.get_redirect_type())
+    max_age = resolved['max_age'] if resolved['max_age'] is not None else config.get_redirect_max_age()
+    headers = cache_headers(max_age)
+    if code is not None and not config.matomo_is_enabled():
+        # Without tracking there is nothing to render
+        return code, {'Location': resolved['url'], **headers}, b''
+    return 200, {'Content-Type': 'text/html; charset=utf-8', **headers}, render_redirect_page(resolved['url'])
+
+def client_ip(forwarded_for, remote_addr):
+    return [item.strip() for item in (forwarded_for or remote_addr or '').split(',')][0]
+
 @app.route('/<string:key>', methods=['GET'])
 def redirect_to_url(key):
-    ip = [item.strip() for item in request.headers.get('X-Forwarded-For', request.remote_addr).split(',')][0]
-    allowed = db._allow_request(ip)
+    ip = client_ip(request.headers.get('X-Forwarded-For'), request.remote_addr)
+    allowed = limiter.allow(ip)
     
     if not allowed:
         return {'message': 'Not allowed', 'error': 'too many requests'}, 500
     
-    redirect_url = db._get_redirect(key)
+    resolved = db._resolve(key)
     
-    if redirect_url is not None:
-        db._add_event(key=key, source=ip)
-        return render_template('redirect.html',
-                               redirect=redirect_url,
-                               matomo=config.get_matomo(),
-                               matomo_is_enabled = config.matomo_is_enabled(),
-                               )
+    if resolved is not None:
+        events.add(key=key, source=ip)
+        status, headers, body = redirect_response(resolved)
+        return Response(body, status=status, headers=headers)
     else:
         return redirect(url_for('index'), code=303)
 
+## STATISTICS
+stats_config = config.get_stats()
+# Statistics per query, recomputed after the TTL as new clicks arrive
+stats_cache = LRUCache(size=stats_config['cache_size'], ttl=stats_config['cache_ttl'])
+db.add_invalidation_listener(stats_cache.clear)
+
+def parse_time(value):
+    """Parses an ISO 8601 timestamp as naive UTC time."""
+    if not value:
+        return None
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+stats_parser = reqparse.RequestParser()
+stats_parser.add_argument('key', type=str, help='A redirect or alias key, omit for the top list', location='args')
+stats_parser.add_argument('start', type=parse_time, help='Start of the time range (ISO 8601, UTC)', location='args')
+stats_parser.add_argument('end', type=parse_time, help='End of the time range (ISO 8601, UTC), exclusive', location='args')
+stats_parser.add_argument('top', type=int, default=10, help='Length of the top list', location='args')
+stats_parser.add_argument('period', type=str, default='day', choices=list(ROLLUPS), help='Bucket size of the series', location='args')
+stats_parser.add_argument('source', type=str, help='Only count the clicks of this source', location='args')
+class Stats(Resource):
+    @require_auth
+    def get(self):
+        args = stats_parser.parse_args()
+        args['top'] = min(max(1, args['top']), stats_config['max_top'])
+        cache_key = tuple(sorted(args.items()))
+        version = stats_cache.version
+        stats = stats_cache.get(cache_key)
+        if stats is MISS:
+            try:
+                stats = db._get_stats(**args)
+            except Exception as e:
+                return {'message': 'Failed to compute statistics', 'error': str(e)}, 500
+            stats_cache.set(cache_key, stats, version)
+        if stats is None:
+            return {'message': 'Key not found', 'key': args['key']}, 404
+        payload = {**stats, **{name: args[name] and args[name].isoformat() for name in ('start', 'end')}}
+        if 'series' in payload:
+            payload['series'] = [{**row, 'bucket': row['bucket'].isoformat()} for row in payload['series']]
+        return payload, 200
+api.add_resource(Stats, '/api/stats')
+
+## KEY FILTER
+class KeyFilter(Resource):
+    @require_auth
+    def get(self):
+        # Every worker keeps its own filter
+        return {'pid': os.getpid(), **db._key_filter_stats()}, 200
+api.add_resource(KeyFilter, '/api/key_filter')
+
 ## HEALTHCHECK
 class HealthCheck(Resource):
     def get(self):
-        return {'status': 'healthy'}, 200
+        # Stays 200 when saturated: restarting an overloaded container only makes it worse
+        status = 'saturated' if admission.saturated() else 'healthy'
+        return {'status': status, 'pid': os.getpid(), 'admission': admission.stats()}, 200
 api.add_resource(HealthCheck, '/api/health')
 
 ## VERSIONS
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics in the Prometheus text exposition format
+"""
+from bisect import bisect_left
+from functools import wraps
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics:
+    """
+    Counters, histograms and gauges of one worker process.
+
+    Every worker periodically writes a snapshot to a shared directory; the exposition merges
+    the snapshots of all workers, so counters and histograms add up across gunicorn workers.
+    Snapshots of workers that are no longer running are removed; the gunicorn master clears the
+    directory when it starts (gunicorn.conf.py).
+    """
+    def __init__(self, directory=None, flush_interval=5):
+        """
+        :param directory: Directory shared by all workers. ``None`` only exposes this process.
+        :param flush_interval: Minimum seconds between two snapshots of this process.
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metadata = {}
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._next_flush = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.flush)
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """
+        Declare a metric.
+
+        :param name: The metric name.
+        :param kind: 'counter', 'histogram' or 'gauge'.
+        :param help_text: The HELP line.
+        :param buckets: Upper bounds of the histogram buckets.
+        """
+        self.metadata[name] = {'type': kind, 'help': help_text, 'buckets': tuple(buckets or DEFAULT_BUCKETS)}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self.metadata[name]['buckets']
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect_left(buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_collector(self, collector):
+        """
+        Register a callable returning (kind, name, labels, value) samples that are read at snapshot time,
+        e.g. counters kept by other components. Collected counters must be monotonic per process.
+        """
+        self.collectors.append(collector)
+
+    def instrument(self, obj, names, metric='db_query_duration_seconds'):
+        """
+        Wrap methods of an object so that their duration is observed in a histogram labelled by method.
+
+        :param obj: The object whose methods are wrapped.
+        :param names: The method names.
+        :param metric: The histogram name.
+        """
+        for name in names:
+            setattr(obj, name, self._timed(getattr(obj, name), metric, (('method', name),)))
+
+    def _timed(self, func, metric, labels):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(metric, time.perf_counter() - start, labels)
+        return timed
+
+    def snapshot(self):
+        """
+        :return: A JSON serializable snapshot of this process.
+        """
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [
+                [name, list(labels), list(histogram['counts']), histogram['sum'], histogram['count']]
+                for (name, labels), histogram in self.histograms.items()
+            ]
+        gauges = []
+        for collector in self.collectors:
+            for kind, name, labels, value in collector():
+                if kind == 'gauge':
+                    gauges.append([name, list(labels), value])
+                else:
+                    counters.append([name, list(labels), value])
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def maybe_flush(self):
+        """
+        Write a snapshot if the last one is older than flush_interval.
+        """
+        if self.directory and time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        self._next_flush = time.monotonic() + self.flush_interval
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        try:
+            with open(path + '.tmp', 'w') as file:
+                json.dump(self.snapshot(), file)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Failed to write metrics: {e}")
+
+    def _snapshots(self):
+        snapshots = {os.getpid(): self.snapshot()}
+        if not self.directory:
+            return snapshots
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if snapshot['pid'] in snapshots:
+                continue
+            if not pid_is_running(snapshot['pid']):
+                remove_snapshot(path)
+                continue
+            snapshots[snapshot['pid']] = snapshot
+        return snapshots
+
+    def expose(self):
+        """
+        Merge the snapshots of all workers.
+
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        counters = {}
+        histograms = {}
+        gauges = {}
+        for snapshot in self._snapshots().values():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, {'counts': [0] * len(counts), 'sum': 0.0, 'count': 0})
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], counts)]
+                merged['sum'] += total
+                merged['count'] += count
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                gauges[key] = gauges.get(key, 0) + value
+
+        lines = []
+        for name, meta in sorted(self.metadata.items()):
+            lines.append(f"# HELP {name} {meta['help']}")
+            lines.append(f"# TYPE {name} {meta['type']}")
+            if meta['type'] == 'histogram':
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(meta['buckets'] + (float('inf'),), histogram['counts']):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram['sum'])}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+            else:
+                samples = counters if meta['type'] == 'counter' else gauges
+                for (metric, labels), value in sorted(samples.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+def pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def remove_snapshot(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def clear_snapshots(directory):
+    """
+    Remove the snapshots of all workers, e.g. those left over from a previous run.
+
+    :param directory: The directory shared by the workers.
+    """
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+        remove_snapshot(path)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rate limiting
+"""
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+BACKENDS = ('memory', 'sqlite')
+
+def sliding_window(state, now, window, limit):
+    """
+    Sliding window counter: the previous window's count is weighted by how much
+    of it still overlaps the trailing window.
+
+    :param state: (window index, count in that window, count in the window before) or None.
+    :param now: The current time in seconds.
+    :param window: The window length in seconds.
+    :param limit: The number of requests allowed per window.
+    :return: (allowed, new state)
+    """
+    index = int(now // window)
+    if state is None:
+        current, previous = 0, 0
+    else:
+        last_index, current, previous = state
+        if last_index == index - 1:
+            current, previous = 0, current
+        elif last_index != index:
+            current, previous = 0, 0
+
+    elapsed = (now % window) / window
+    estimate = previous * (1 - elapsed) + current
+    if estimate >= limit:
+        return False, (index, current, previous)
+    return True, (index, current + 1, previous)
+
+class MemoryStore:
+    """
+    Per-process counters with LRU eviction of idle sources.
+    """
+    def __init__(self, max_sources=100000, **kwargs):
+        self.max_sources = int(max_sources)
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, source, now, window, limit):
+        with self._lock:
+            allowed, state = sliding_window(self._states.get(source), now, window, limit)
+            self._states[source] = state
+            self._states.move_to_end(source)
+            while len(self._states) > self.max_sources:
+                self._states.popitem(last=False)
+            return allowed
+
+class SQLiteStore:
+    """
+    Counters shared by all workers through a small SQLite file.
+    """
+    def __init__(self, path='data/ratelimit.db', max_sources=100000, **kwargs):
+        self.path = path
+        self.max_sources = int(max_sources)
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    source TEXT PRIMARY KEY,
+                    window INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    previous INTEGER NOT NULL,
+                    touched REAL NOT NULL
+                )""")
+            con.execute("CREATE INDEX IF NOT EXISTS ix_rate_limits_touched ON rate_limits (touched)")
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def hit(self, source, now, window, limit):
+        con = self._connection()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            state = con.execute("SELECT window, count, previous FROM rate_limits WHERE source = ?", (source,)).fetchone()
+            allowed, (index, current, previous) = sliding_window(state, now, window, limit)
+            con.execute(
+                "INSERT INTO rate_limits (source, window, count, previous, touched) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET window = excluded.window, count = excluded.count, "
+                "previous = excluded.previous, touched = excluded.touched",
+                (source, index, current, previous, now),
+            )
+            self._hits += 1
+            if self._hits % 1000 == 0:
+                self._prune(con, now, window)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return allowed
+
+    def _prune(self, con, now, window):
+        """
+        Forget sources that were idle for two windows and cap the table at max_sources.
+        """
+        con.execute("DELETE FROM rate_limits WHERE touched < ?", (now - 2 * window,))
+        con.execute(
+            "DELETE FROM rate_limits WHERE source IN ("
+            "SELECT source FROM rate_limits ORDER BY touched DESC LIMIT -1 OFFSET ?)",
+            (self.max_sources,),
+        )
+
+class RateLimiter:
+    """
+    Limits the number of requests per source within a sliding time window.
+    """
+    def __init__(self, enabled=True, limit=30, window=120, backend='memory', **kwargs):
+        """
+        :param enabled: Set to False to allow every request.
+        :param limit: Number of requests allowed per source and window.
+        :param window: Window length in seconds.
+        :param backend: 'memory' for per-worker counters, 'sqlite' to share counters between workers.
+        :param kwargs: Backend settings ('max_sources', 'path').
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown rate limit backend '{backend}', expected one of {BACKENDS}.")
+
+        self.enabled = enabled
+        self.limit = int(limit)
+        self.window = float(window)
+        self.store = SQLiteStore(**kwargs) if backend == 'sqlite' else MemoryStore(**kwargs)
+        self.rejected = 0
+
+    def allow(self, source):
+        """
+        Count a request and check if the source is within its limit.
+
+        :param source: The source (IP address) of the request.
+        :return: True if the request is allowed, False otherwise.
+        """
+        if not self.enabled:
+            return True
+        try:
+            allowed = self.store.hit(source, time.time(), self.window, self.limit)
+        except Exception as e:
+            # A broken store must not take the redirects down with it
+            print(f"Rate limiter error: {e}")
+            return True
+        if not allowed:
+            self.rejected += 1
+        return allowed
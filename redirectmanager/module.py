@@ -3,9 +3,15 @@
 """
 client
 """
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from tqdm import tqdm
+import csv
 import os
+from urllib.parse import urlencode
 import sys
 from packaging.version import Version
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
@@ -15,56 +21,185 @@ from importlib.metadata import version, PackageNotFoundError
 import redirectmanager
 
 class RequestHandler:
+    """
+    Sends authorized requests over pooled keep-alive sessions.
+
+    Failed requests (429 and 5xx, connection errors) are retried with exponential backoff.
+    Most write endpoints are idempotent upserts, so POST and DELETE are retried as well.
+    Requests sent with retry=False (staging loads append rows, swap and rollback change the
+    dataset) are only retried if the connection could not be established, i.e. before the
+    server received them.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
     def __init__(self, **kwargs):
         self.host = kwargs.get('host')
         self.key = kwargs.get('key')
         self.headers = {'Authorization': self.key}
+        # (connect, read) timeout in seconds
+        self.timeout = kwargs.get('timeout', (5, 60))
+        pool_size = kwargs.get('pool_size', 10)
+        self.session = self._create_session(kwargs, pool_size)
+        self.single_session = self._create_session(kwargs, pool_size, read=0, status=0, other=0)
 
-    def post(self, endpoint, payload):
-        url = f"{self.host}{endpoint}"
-        response = requests.post(url, json=payload, headers=self.headers)
-        return self._handle_response(response)
+    def _create_session(self, kwargs, pool_size, **limits):
+        # limits of 0 allow only the retries of connection errors, i.e. of requests that were not sent
+        retry = Retry(
+            total=kwargs.get('retries', 3),
+            backoff_factor=kwargs.get('backoff_factor', 0.5),
+            status_forcelist=self.RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'POST', 'DELETE']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            **limits,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
-    def get(self, endpoint):
-        url = f"{self.host}{endpoint}"
-        response = requests.get(url, headers=self.headers)
-        return self._handle_response(response)
+    def post(self, endpoint, payload, retry=True):
+        return self._request('POST', endpoint, retry=retry, json=payload)
+
+    def get(self, endpoint, headers=None):
+        return self._request('GET', endpoint, headers=headers)
 
     def delete(self, endpoint):
+        return self._request('DELETE', endpoint)
+
+    def close(self):
+        self.session.close()
+        self.single_session.close()
+
+    def _request(self, method, endpoint, retry=True, **kwargs):
         url = f"{self.host}{endpoint}"
-        response = requests.delete(url, headers=self.headers)
+        session = self.session if retry else self.single_session
+        try:
+            response = session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            return {'status': False, 'response': {'message': 'Request failed', 'error': str(e)}}
         return self._handle_response(response)
 
     def _handle_response(self, response):
+        if response.status_code == 304:
+            return {'status': True, 'response': None, 'not_modified': True, 'etag': response.headers.get('ETag')}
+        try:
+            body = response.json()
+        except ValueError:
+            # e.g. an HTML error page of a proxy
+            body = {'message': response.text[:1000], 'status_code': response.status_code}
         if response.status_code in [200, 201]:
-            return {'status': True, 'response': response.json()}
+            return {'status': True, 'response': body, 'etag': response.headers.get('ETag')}
         else:
-            return {'status': False, 'response': response.json()}
+            return {'status': False, 'response': body}
 
 class SheetParser:
+    """
+    Streams the records of a redirect sheet without loading it into memory.
+
+    A .csv file holds redirects (columns key, redirect and optionally redirect_type and max_age),
+    a .xlsx file a 'redirect' and optionally an 'alias' sheet (columns alias, key).
+    Rows without the required values are skipped and listed in `skipped`.
+    """
+    REDIRECT_COLUMNS = ('key', 'redirect')
+    ALIAS_COLUMNS = ('alias', 'key')
+
     def __init__(self, file_path):
         self.file_path = file_path
-        self.redirect = None
-        self.alias = None
-        self.load_data()
+        self.extension = os.path.splitext(self.file_path)[1].lower()
+        if self.extension not in ('.csv', '.xlsx'):
+            raise ValueError("Unsupported file type. Please provide a .csv or .xlsx file.")
+        self.skipped = []
 
-    def load_data(self):
-        # Überprüfen der Dateiendung
-        file_extension = os.path.splitext(self.file_path)[1].lower()
-        
-        if file_extension == '.csv':
-            # CSV-Datei laden
-            self.redirect = pd.read_csv(self.file_path)
-        elif file_extension == '.xlsx':
-            # Excel-Datei laden und überprüfen, ob die benötigten Sheets existieren
-            xls = pd.ExcelFile(self.file_path)
-            if 'redirect' in xls.sheet_names:
-                self.redirect = pd.read_excel(xls, sheet_name='redirect')
-            if 'alias' in xls.sheet_names:
-                self.alias = pd.read_excel(xls, sheet_name='alias')
+    def iter_redirects(self):
+        """
+        Yields {'key', 'redirect'[, 'redirect_type', 'max_age']} records.
+        """
+        for line, row in self._validated_rows('redirect', self.REDIRECT_COLUMNS):
+            record = {'key': row['key'], 'redirect': row['redirect']}
+            if row.get('redirect_type'):
+                record['redirect_type'] = row['redirect_type']
+            if row.get('max_age'):
+                try:
+                    record['max_age'] = int(row['max_age'])
+                except ValueError:
+                    self.skipped.append({'sheet': 'redirect', 'row': line, 'invalid': ['max_age']})
+                    continue
+            yield record
+
+    def iter_aliases(self):
+        """
+        Yields {'alias', 'key'} records.
+        """
+        for line, row in self._validated_rows('alias', self.ALIAS_COLUMNS):
+            yield {'alias': row['alias'], 'key': row['key']}
+
+    def operations(self):
+        """
+        Yields the bulk operations of the sheet, redirects before aliases.
+        """
+        for record in self.iter_redirects():
+            yield {'type': 'redirect', **record}
+        for record in self.iter_aliases():
+            yield {'type': 'alias', **record}
+
+    @property
+    def redirect(self):
+        return self._dataframe(self.iter_redirects(), self.REDIRECT_COLUMNS)
+
+    @property
+    def alias(self):
+        return self._dataframe(self.iter_aliases(), self.ALIAS_COLUMNS)
+
+    def _dataframe(self, records, columns):
+        import pandas as pd
+        records = list(records)
+        return pd.DataFrame(records, columns=None if records else list(columns))
+
+    def _validated_rows(self, sheet, required):
+        self.skipped = [entry for entry in self.skipped if entry['sheet'] != sheet]
+        for line, row in self._rows(sheet):
+            missing = [column for column in required if not row.get(column)]
+            if missing:
+                if any(row.values()):
+                    self.skipped.append({'sheet': sheet, 'row': line, 'missing': missing})
+                continue
+            yield line, row
+
+    def _rows(self, sheet):
+        """
+        Yields (row number, {column: stripped string}) of a sheet.
+        """
+        if self.extension == '.csv':
+            if sheet != 'redirect':
+                return
+            with open(self.file_path, newline='', encoding='utf-8-sig') as file:
+                reader = csv.reader(file)
+                header = [normalize_cell(cell).lower() for cell in next(reader, [])]
+                for line, values in enumerate(reader, start=2):
+                    yield line, dict(zip(header, map(normalize_cell, values)))
         else:
-            raise ValueError("Unsupported file type. Please provide a .csv or .xlsx file.")
-        
+            import openpyxl
+            workbook = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
+            try:
+                if sheet not in workbook.sheetnames:
+                    return
+                rows = workbook[sheet].iter_rows(values_only=True)
+                header = [normalize_cell(cell).lower() for cell in next(rows, ())]
+                for line, values in enumerate(rows, start=2):
+                    yield line, dict(zip(header, map(normalize_cell, values)))
+            finally:
+                workbook.close()
+
+def normalize_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
 class RedirectManager:
     def __init__(self, **kwargs):
         self.host = kwargs.get('host')
@@ -74,7 +209,21 @@ class RedirectManager:
         if self.key is None:
             raise ValueError("Key must be provided.")
             
-        self.request_handler = RequestHandler(host = self.host, key = self.key)
+        # Number of concurrent requests of batch operations
+        self.workers = max(1, int(kwargs.get('workers', 4)))
+        self.progress = kwargs.get('progress', True)
+        self.request_handler = RequestHandler(
+            host = self.host,
+            key = self.key,
+            timeout = kwargs.get('timeout', (5, 60)),
+            retries = kwargs.get('retries', 3),
+            backoff_factor = kwargs.get('backoff_factor', 0.5),
+            pool_size = self.workers,
+        )
+        self._redirects_etag = None
+        self._redirects = None
+        self._export_etag = None
+        self._export = None
         
         self._check_if_client_fit_server()
         
@@ -111,14 +260,45 @@ class RedirectManager:
             'redirect': kwargs.get('redirect'),
             'key': kwargs.get('key'),
         }
+        for name in ('redirect_type', 'max_age'):
+            if kwargs.get(name) is not None:
+                payload[name] = kwargs[name]
         return self.request_handler.post("/api/add_redirect", payload)
 
     def get_all_redirects(self):
-        response = self.request_handler.get("/api/get_all_redirects")
-        if response.get('status')==True:
-            return pd.DataFrame(response.get('response', {}).get('redirects', {}))
+        # Conditional request: the server answers 304 while the redirects are unchanged
+        headers = {'If-None-Match': self._redirects_etag} if self._redirects_etag else None
+        response = self.request_handler.get("/api/get_all_redirects", headers=headers)
+        if response.get('not_modified')==True and self._redirects is not None:
+            return self._redirects.copy()
+        if response.get('status')==True and response.get('response') is not None:
+            import pandas as pd
+            self._redirects = pd.DataFrame(response.get('response', {}).get('redirects', {}))
+            self._redirects_etag = response.get('etag')
+            return self._redirects.copy()
         return None
 
+    def get_stats(self, key=None, start=None, end=None, top=10, period='day', source=None):
+        """
+        Click statistics as a DataFrame: the top redirects, or with a key the hits per bucket.
+        The totals (and for a key the hits per alias) are kept in DataFrame.attrs.
+        """
+        import pandas as pd
+        params = {'key': key, 'start': start, 'end': end, 'top': top, 'period': period, 'source': source}
+        params = {name: value.isoformat() if hasattr(value, 'isoformat') else value
+                  for name, value in params.items() if value is not None}
+        response = self.request_handler.get(f"/api/stats?{urlencode(params)}")
+        if response.get('status') != True:
+            raise ValueError(f"Statistics failed: {response.get('response')}")
+        stats = response.get('response', {})
+        if key is None:
+            frame = pd.DataFrame(stats.get('top', []), columns=['key', 'hits', 'canonical', 'aliases'])
+        else:
+            frame = pd.DataFrame(stats.get('series', []), columns=['bucket', 'hits', 'sources'])
+            frame['bucket'] = pd.to_datetime(frame['bucket'])
+        frame.attrs.update({name: value for name, value in stats.items() if name not in ('top', 'series')})
+        return frame
+
     def delete_all_redirects(self):
         return self.request_handler.delete("/api/delete_all_redirects")
 
@@ -129,15 +309,197 @@ class RedirectManager:
         }
         return self.request_handler.post("/api/add_alias", payload)
 
-    def update_from_file(self, file_path):
-        csv = SheetParser(file_path)
-        if not isinstance(csv.redirect,type(None)):
-            for index, row in csv.redirect.iterrows():
-                self.add_redirect(**row)
-        if not isinstance(csv.alias,type(None)):
-            for index, row in csv.alias.iterrows():
-                self.add_alias(**row)
-        
+    def bulk(self, operations, chunk_size=5000):
+        """
+        Sends redirect/alias operations to /api/bulk, chunk_size operations per request.
+        `operations` may be any iterable; it is consumed chunk by chunk.
+        Chunks are sent concurrently by up to `workers` threads; an alias is only sent
+        after all redirects listed before it, so it can refer to them.
+        Returns the summed totals and the rows that failed.
+        """
+        return self._upload(operations, chunk_size, self._send_bulk_chunk)
+
+    def _upload(self, operations, chunk_size, send):
+        totals = {}
+        errors = []
+        pending = deque()
+        total = len(operations) if hasattr(operations, '__len__') else None
+        progress = tqdm(total=total, unit='op', disable=not self.progress)
+        with progress, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start, chunk, new_phase in self._chunks(operations, chunk_size):
+                # Wait for the previous phase, and keep at most two chunks per worker in memory
+                while pending and (new_phase or len(pending) >= 2 * self.workers):
+                    self._collect_bulk(pending.popleft(), totals, errors, progress)
+                pending.append((start, len(chunk), executor.submit(send, chunk)))
+            while pending:
+                self._collect_bulk(pending.popleft(), totals, errors, progress)
+        return {'totals': totals, 'errors': errors}
+
+    def _send_bulk_chunk(self, chunk):
+        return self.request_handler.post("/api/bulk?results=errors", {'operations': chunk})
+
+    def _send_stage_chunk(self, chunk):
+        # Loading appends to the staged rows, a retried chunk would be staged twice
+        return self.request_handler.post("/api/staging/load", {'operations': chunk}, retry=False)
+
+    def _collect_bulk(self, item, totals, errors, progress):
+        start, size, future = item
+        response = future.result()
+        if response.get('status') != True:
+            raise ValueError(f"Upload failed: {response.get('response')}")
+        report = response.get('response', {})
+        for status, count in report.get('totals', {}).items():
+            totals[status] = totals.get(status, 0) + count
+        for result in report.get('results', []):
+            errors.append({**result, 'index': result['index'] + start})
+        progress.update(size)
+
+    @staticmethod
+    def _chunks(operations, chunk_size):
+        """
+        Yields (index of the first operation, chunk, new_phase). A chunk only holds operations
+        of one type; new_phase is set when the type differs from the previous chunk.
+        """
+        chunk = []
+        start = 0
+        kind = None
+        new_phase = False
+        for index, operation in enumerate(operations):
+            if chunk and (len(chunk) >= chunk_size or operation.get('type') != kind):
+                yield start, chunk, new_phase
+                new_phase = operation.get('type') != kind
+                chunk = []
+                start = index
+            kind = operation.get('type')
+            chunk.append(operation)
+        if chunk:
+            yield start, chunk, new_phase
+
+    def export(self):
+        """
+        Returns the stored redirects and aliases as {'redirects': [...], 'aliases': [...]}.
+        The last export is cached and only downloaded again when the server's version changed.
+        """
+        headers = {'If-None-Match': self._export_etag} if self._export_etag else None
+        response = self.request_handler.get("/api/export", headers=headers)
+        if response.get('not_modified')==True and self._export is not None:
+            return self._export
+        if response.get('status')==True and response.get('response') is not None:
+            self._export = response.get('response')
+            self._export_etag = response.get('etag')
+            return self._export
+        raise ValueError(f"Export failed: {response.get('response')}")
+
+    def sync(self, file_path, prune=False, dry_run=False, chunk_size=5000):
+        """
+        Brings the server in line with a sheet and only sends the rows that differ.
+
+        :param file_path: The .csv or .xlsx sheet.
+        :param prune: Also delete redirects and aliases that are not in the sheet.
+        :param dry_run: Only report what would change.
+        :return: The keys to create, update and delete per redirects and aliases, and the bulk totals and errors.
+        """
+        sheet = SheetParser(file_path)
+        redirects = {record['key']: record for record in sheet.iter_redirects()}
+        aliases = {record['alias']: record['key'] for record in sheet.iter_aliases()}
+        state = self.export()
+        server_redirects = {row['key']: row for row in state.get('redirects', [])}
+        server_aliases = {row['alias']: row['key'] for row in state.get('aliases', [])}
+
+        report = {
+            'redirects': {'create': [], 'update': [], 'delete': []},
+            'aliases': {'create': [], 'update': [], 'delete': []},
+            'unchanged': 0,
+            'skipped': sheet.skipped,
+        }
+        deletes = []
+        upserts = []
+        for key, record in redirects.items():
+            current = server_redirects.get(key)
+            if current is None:
+                report['redirects']['create'].append(key)
+            elif any(record.get(name) != value for name, value in current.items() if name != 'key'):
+                report['redirects']['update'].append(key)
+            else:
+                report['unchanged'] += 1
+                continue
+            upserts.append({'type': 'redirect', **record})
+        for alias, key in aliases.items():
+            current = server_aliases.get(alias)
+            if current is None:
+                report['aliases']['create'].append(alias)
+            elif current != key:
+                report['aliases']['update'].append(alias)
+            else:
+                report['unchanged'] += 1
+                continue
+            upserts.append({'type': 'alias', 'alias': alias, 'key': key})
+        if prune:
+            # Aliases are deleted before redirects, as deleting a redirect also removes its aliases
+            for alias in server_aliases:
+                if alias not in aliases and alias not in redirects:
+                    report['aliases']['delete'].append(alias)
+                    deletes.append({'type': 'delete', 'key': alias})
+            for key in server_redirects:
+                if key not in redirects:
+                    report['redirects']['delete'].append(key)
+                    deletes.append({'type': 'delete', 'key': key})
+
+        if not dry_run and (deletes or upserts):
+            report.update(self.bulk(deletes + upserts, chunk_size=chunk_size))
+        return report
+
+    def stage(self, operations, chunk_size=5000):
+        """
+        Uploads redirect/alias operations to the server's staged dataset, like bulk().
+        Nothing changes for the live redirects until swap_staging().
+        """
+        return self._upload(operations, chunk_size, self._send_stage_chunk)
+
+    def get_staging(self):
+        """
+        Returns the validation report of the staged dataset (duplicate keys, dangling aliases).
+        """
+        return self.request_handler.get("/api/staging")
+
+    def clear_staging(self):
+        return self.request_handler.delete("/api/staging")
+
+    def swap_staging(self):
+        """
+        Replaces all redirects and aliases with the staged dataset at once; fails if it is not valid.
+        """
+        return self.request_handler.post("/api/staging/swap", {}, retry=False)
+
+    def rollback_dataset(self):
+        """
+        Restores the redirects and aliases that the last swap replaced. Works once per swap.
+        """
+        return self.request_handler.post("/api/staging/rollback", {}, retry=False)
+
+    def replace_from_file(self, file_path, chunk_size=5000):
+        """
+        Replaces all redirects and aliases with the sheet in one atomic swap: the rows are staged,
+        validated and swapped in by the server. Keys that return keep their statistics, and
+        rollback_dataset() restores the replaced set.
+
+        :return: The upload totals and errors, the skipped rows and the swap report.
+        """
+        sheet = SheetParser(file_path)
+        cleared = self.clear_staging()
+        if cleared.get('status') != True:
+            raise ValueError(f"Clearing the staged dataset failed: {cleared.get('response')}")
+        result = self.stage(sheet.operations(), chunk_size=chunk_size)
+        result['skipped'] = sheet.skipped
+        result['swap'] = self.swap_staging()
+        return result
+
+    def update_from_file(self, file_path, chunk_size=5000):
+        sheet = SheetParser(file_path)
+        result = self.bulk(sheet.operations(), chunk_size=chunk_size)
+        result['skipped'] = sheet.skipped
+        return result
+
 if __name__ == "__main__":
     host = "http://localhost:5000"
     auth_key = "test"
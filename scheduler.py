@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+background jobs
+"""
+import os
+import threading
+import time
+
+class Scheduler:
+    """
+    Runs registered jobs at fixed intervals in a background thread of each worker.
+    Jobs that must only run in one worker at a time take a lease in the database.
+    """
+    def __init__(self, lease=None, tick=1):
+        """
+        :param lease: Callable (name, seconds) -> bool that takes a lease shared by all workers.
+        :param tick: How often (in seconds) the thread checks for due jobs.
+        """
+        self.lease = lease
+        self.tick = tick
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = None
+        self._thread = None
+
+    def add(self, name, func, interval, exclusive=False, **kwargs):
+        """
+        Register a job.
+
+        :param name: The name of the job.
+        :param func: The callable to run.
+        :param interval: Seconds between two runs. ``0`` or ``None`` disables the job.
+        :param exclusive: Run the job in only one worker per interval.
+        :param kwargs: Keyword arguments passed to the job.
+        """
+        if not interval:
+            return
+        self.jobs[name] = {
+            'func': func,
+            'interval': float(interval),
+            'exclusive': exclusive,
+            'kwargs': kwargs,
+            'next_run': time.monotonic() + float(interval),
+            'last_result': None,
+            'last_error': None,
+        }
+
+    def start(self):
+        """
+        Start the scheduler thread, once per process.
+        """
+        if self._pid == os.getpid() or not self.jobs:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            for name, job in self.jobs.items():
+                if job['next_run'] > time.monotonic():
+                    continue
+                job['next_run'] = time.monotonic() + job['interval']
+                try:
+                    if job['exclusive'] and not self.lease(f'lease_{name}', job['interval']):
+                        continue
+                    job['last_result'] = job['func'](**job['kwargs'])
+                    job['last_error'] = None
+                except Exception as e:
+                    job['last_error'] = str(e)
+                    print(f"Job '{name}' failed: {e}")